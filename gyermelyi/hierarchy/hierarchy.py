@@ -1,8 +1,12 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 import logging
+import numpy as np
 import pandas as pd
 from bennet.config import Config
 from .hierarchydbfactory import HierarchyDBFactory
+from . import hierarchyjit
 
 logger = logging.getLogger(__name__)
 
@@ -12,11 +16,11 @@ class Hierarchy:
     A class to represent a hierarchical structure based on parent-child relationships.
 
     :ivar source: A list of lists or a pandas DataFrame where each sublist or row contains a parent-child pair.
-    :ivar hierarchy: A set to store hierarchical paths.
+    :ivar hierarchy: A list to store hierarchical paths, each path appearing once.
     :ivar level: The prefix for level column names in the flattened hierarchy.
     :ivar primkey: The name for the primary key column in the flattened hierarchy.
-    :ivar parent_map: A dictionary mapping each parent to its children.
-    :ivar child_map: A dictionary mapping each child to its parents.
+    :ivar parent_map: A dictionary mapping each parent to the list of its children.
+    :ivar child_map: A dictionary mapping each child to the list of its parents.
     """
 
     def __init__(self, source: list | tuple | pd.DataFrame = None, config_file=None):
@@ -27,8 +31,10 @@ class Hierarchy:
         :param config_file: Path to the configuration file for database connection.
         """
         self.hierarchy = None
+        self._max_depth = 0
         self.source = None
         self.metadata = None
+        self._destination = None
         self.hierarchydb = None
 
         self._validate(source, config_file)
@@ -36,8 +42,8 @@ class Hierarchy:
         self.level = 'LVL'
         self.primkey = 'PK'
 
-        self.parent_map = defaultdict(set)
-        self.child_map = defaultdict(set)
+        self.parent_map = defaultdict(list)
+        self.child_map = defaultdict(list)
 
     def _validate(self, source, config_file):
         """
@@ -79,60 +85,267 @@ class Hierarchy:
     def _create_mapping(self):
         """
         Create parent-child mappings from the source data.
+        The mappings are rebuilt from scratch; as duplicate edges are dropped beforehand, the children and parents are kept in lists.
+
+        :return: The parents and the children of the edges, and the nodes defined by self-loops only.
         """
+        self.parent_map = defaultdict(list)
+        self.child_map = defaultdict(list)
+
         if isinstance(self.source, pd.DataFrame):
-            for _, row in self.source.iterrows():
-                parent, child = row
-                if parent != child:
-                    self.parent_map[parent].add(child)
-                    self.child_map[child].add(parent)
-                else:
-                    self.parent_map[parent]
+            source = self.source
         else:
-            for parent, child in self.source:
-                if parent != child:
-                    self.parent_map[parent].add(child)
-                    self.child_map[child].add(parent)
-                else:
-                    self.parent_map[parent]
+            source = pd.DataFrame(list(self.source), columns=[0, 1], dtype=object)
+
+        parent_column, child_column = source.iloc[:, 0], source.iloc[:, 1]
+        # Nullable dtypes compare a missing value as <NA>, which would leave the row out of both the self-loops and the edges;
+        # a row without parent and child counts as a self-loop
+        is_self_loop = parent_column.eq(child_column).fillna(False).astype(bool) | (parent_column.isna() & child_column.isna())
+        loops = source.loc[is_self_loop].iloc[:, 0].unique().tolist()
+        for parent in loops:
+            self.parent_map[parent]
+
+        edges = source.loc[~is_self_loop].drop_duplicates()
+        parents, children = edges.iloc[:, 0].tolist(), edges.iloc[:, 1].tolist()
+        for parent, child in zip(parents, children):
+            self.parent_map[parent].append(child)
+            self.child_map[child].append(parent)
+        return parents, children, loops
+
+    def _check_cycles(self):
+        """
+        Check that the parent-child mappings contain no cycle.
+        The compiled traversal runs it before any path is built; the Python traversal, which catches the cycles reachable
+        from a root itself, only when some nodes were not reached from any root.
 
-    def _find_root(self, node):
+        The nodes are peeled off in topological order (Kahn's algorithm): a node is taken once all of its parents have been taken,
+        so the nodes left over are on a cycle or below one. Walking up the left over parents from any of them must then run into a cycle.
+        Every node and edge is visited once; self-loops are dropped when the mappings are created, so they are not cycles.
+
+        :raises ValueError: If a cycle is found, naming one of its nodes.
+        """
+        indegree = {child: len(parents) for child, parents in self.child_map.items()}
+        queue = [node for node in self.parent_map if node not in indegree]
+        for node in queue:
+            for child in self.parent_map.get(node, ()):
+                indegree[child] -= 1
+                if not indegree[child]:
+                    queue.append(child)
+
+        remaining = {node for node, degree in indegree.items() if degree}
+        if remaining:
+            node = next(node for node in indegree if node in remaining)
+            visited = set()
+            while node not in visited:
+                visited.add(node)
+                node = next(parent for parent in self.child_map[node] if parent in remaining)
+            raise ValueError(f"Cycle detected at node {node!r}")
+
+    def _build_path(self, node, subpaths_cache):
         """
-        Find the root node of a given node by tracing its parents.
+        Build hierarchical paths from the given node with an iterative depth-first traversal.
 
-        :param node: The node for which to find the root.
-        :return: The root node.
+        A single path buffer is shared by the whole traversal: a node is appended when it is entered
+        and popped once all of its children have been visited.
+        The subpaths of nodes with more than one parent are memoized on the first visit, so later visits
+        prepend the current path to the cached subpaths instead of traversing the subtree again.
+        The length of the longest path is tracked along the way, so flattening needs no extra pass.
+        The nodes of the current path are also kept in a set, so a child already on the path is reported as a cycle
+        instead of being traversed again.
+
+        :param node: The starting node for building the path.
+        :param subpaths_cache: The memoized subpaths of the shared nodes, shared by the traversals from all the roots.
+        :return: The number of nodes entered. In a hierarchy without cycles every node reachable from the root is entered once.
+        :raises ValueError: If a cycle is reachable from the node, naming one of its nodes.
         """
-        while node in self.child_map:
-            node = next(iter(self.child_map[node]))
-        return node
+        path = [node]
+        on_path = {node}
+        n_entered = 1
+        self.hierarchy.append(tuple(path))
+        max_depth = max(self._max_depth, 1)
+        stack = [iter(self.parent_map.get(node, ()))]
+        collectors = []  # (depth, node, subpaths) of the shared nodes whose subtree is being traversed
+        while stack:
+            for child in stack[-1]:
+                if child in subpaths_cache:
+                    prefix = tuple(path)
+                    cached, sub_depth = subpaths_cache[child]
+                    paths = [prefix + subpath for subpath in cached]
+                    self.hierarchy.extend(paths)
+                    max_depth = max(max_depth, len(prefix) + sub_depth)
+                    for depth, _, subpaths in collectors:
+                        subpaths.extend(p[depth:] for p in paths)
+                    break
+
+                if child in on_path:
+                    raise ValueError(f"Cycle detected at node {child!r}")
+                path.append(child)
+                on_path.add(child)
+                n_entered += 1
+                p = tuple(path)
+                self.hierarchy.append(p)
+                if len(p) > max_depth:
+                    max_depth = len(p)
+                for depth, _, subpaths in collectors:
+                    subpaths.append(p[depth:])
+                if len(self.child_map.get(child, ())) > 1:
+                    collectors.append((len(path) - 1, child, [p[-1:]]))
+                stack.append(iter(self.parent_map.get(child, ())))
+                break
+            else:
+                stack.pop()
+                if collectors and collectors[-1][0] == len(path) - 1:
+                    _, shared, subpaths = collectors.pop()
+                    subpaths_cache[shared] = (tuple(subpaths), max(map(len, subpaths)))
+                on_path.discard(path.pop())
+        self._max_depth = max_depth
+        return n_entered
+
+    @staticmethod
+    def _to_csr(edges):
+        """
+        Encode the nodes as integer codes and convert the edges into a graph in compressed sparse row (CSR) form.
 
-    def _build_path(self, node, path: list):
+        The codes are assigned with pandas.factorize over all the edge endpoints (and the nodes defined by self-loops),
+        so neither the encoding nor the grouping of the children by parent runs a Python loop.
+        factorize would merge all the missing values (None, NaN) into a single NaN node, so those get their codes
+        from a dictionary instead, keeping them apart and unchanged just like the keys of the mappings.
+
+        :param edges: The parents and the children of the edges, and the nodes defined by self-loops only, as returned by `_create_mapping`.
+        :return: The offsets of the children of each node in the child array, the child array and a list mapping each code to its node.
+        """
+        parents, children, loops = edges
+        n_items = 2 * len(parents) + len(loops)
+        items = np.fromiter(chain(parents, children, loops), dtype=object, count=n_items)
+        codes, uniques = pd.factorize(items)
+        labels = uniques.tolist()
+        missing = {}
+        for i in np.flatnonzero(codes < 0).tolist():
+            codes[i] = missing.setdefault(items[i], len(labels) + len(missing))
+        labels.extend(missing)
+        parent_codes, child_codes = codes[:len(parents)], codes[len(parents):2 * len(parents)]
+        indptr = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parent_codes, minlength=len(labels)), out=indptr[1:])
+        indices = child_codes[np.argsort(parent_codes, kind='stable')].astype(np.int32)
+        return indptr, indices, labels
+
+    @staticmethod
+    def _split_roots(indptr, indices, root_ids, n_tasks):
         """
-        Recursively build hierarchical paths from the given node.
+        Split the traversal from the given roots into independent tasks for parallel workers.
+
+        While there are fewer task roots than `n_tasks`, the task root with the most children is expanded:
+        its own path is emitted up front and its children become task roots, so a hierarchy with few
+        (or a single) large trees is spread over the workers as well.
+
+        :param indptr: The offsets of the children of each node in `indices`.
+        :param indices: The children of the nodes, concatenated.
+        :param root_ids: The ids of the root nodes.
+        :param n_tasks: The number of tasks to aim for.
+        :return: The ids of the expanded nodes and the index of the path each of them extends (-1 for a root),
+            followed by the task roots and the index of the path each of them extends.
+        """
+        degree = np.diff(indptr)
+        expanded_nodes, expanded_parents = [], []
+        task_roots, task_parents = root_ids.tolist(), [-1] * len(root_ids)
+        while 0 < len(task_roots) < n_tasks:
+            i = max(range(len(task_roots)), key=lambda k: degree[task_roots[k]])
+            node, parent = task_roots[i], task_parents[i]
+            if degree[node] == 0:
+                break
+            task_roots[i], task_parents[i] = task_roots[-1], task_parents[-1]
+            task_roots.pop()
+            task_parents.pop()
+
+            expanded_nodes.append(node)
+            expanded_parents.append(parent)
+            children = indices[indptr[node]:indptr[node + 1]].tolist()
+            task_roots.extend(children)
+            task_parents.extend([len(expanded_nodes) - 1] * len(children))
+        return expanded_nodes, expanded_parents, np.asarray(task_roots, dtype=np.int32), np.asarray(task_parents, dtype=np.int64)
+
+    def _build_paths_jit(self, edges, workers=1):
+        """
+        Build hierarchical paths from the given roots with the Numba compiled depth-first traversal.
 
-        :param node: The starting node for building the path.
-        :param path: The current path being built.
+        The traversal records each path as its last node id and the index of the path it extends,
+        so the labeled tuples are rebuilt afterwards by extending the already rebuilt tuples by one node.
+        The compiled functions release the GIL, so independent subtrees are traversed by a thread pool.
+
+        :param edges: The edges of the hierarchy, as returned by `_create_mapping`.
+        :param workers: The number of threads traversing the subtrees.
         """
-        path.append(node)
-        if node not in self.parent_map or not self.parent_map[node]:  # is not a parent or its value is an empty set
-            self.hierarchy.add(tuple(path))
+        indptr, indices, labels = self._to_csr(edges)
+        root_ids = np.flatnonzero(np.bincount(indices, minlength=len(labels)) == 0).astype(np.int32)  # nodes without a parent
+        n_tasks = workers * 4 if workers > 1 else 1
+        if n_tasks > 1:
+            nodes, parents, task_roots, task_parents = self._split_roots(indptr, indices, root_ids, n_tasks)
         else:
-            for child in self.parent_map[node]:
-                self.hierarchy.add(tuple(path))
-                self._build_path(child, path.copy())
-
-    def create_hierarchy(self):
+            nodes, parents, task_roots, task_parents = [], [], root_ids, np.full(len(root_ids), -1, dtype=np.int64)
+
+        def traverse(task):
+            n_paths, max_depth = hierarchyjit.count_paths(indptr, indices, task_roots[task])
+            task_nodes = np.empty(n_paths, dtype=np.int32)
+            task_extends = np.empty(n_paths, dtype=np.int64)
+            hierarchyjit.dfs_paths(indptr, indices, task_roots[task], task_nodes, task_extends, max_depth)
+            return task_nodes, task_extends
+
+        tasks = np.array_split(np.arange(len(task_roots)), max(1, min(n_tasks, len(task_roots))))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(traverse, tasks))
+
+        nodes, parents = [np.asarray(nodes, dtype=np.int32)], [np.asarray(parents, dtype=np.int64)]
+        offset = len(nodes[0])
+        for task, (task_nodes, task_extends) in zip(tasks, results):
+            is_root = task_extends < 0
+            task_extends += offset
+            task_extends[is_root] = task_parents[task]  # the task roots come out in the order they went in
+            nodes.append(task_nodes)
+            parents.append(task_extends)
+            offset += len(task_nodes)
+
+        paths = []
+        for node, parent in zip(np.concatenate(nodes).tolist(), np.concatenate(parents).tolist()):
+            paths.append((paths[parent] if parent >= 0 else ()) + (labels[node],))
+        self.hierarchy.extend(paths)
+        self._max_depth = max(self._max_depth, max(map(len, paths), default=0))
+
+    def create_hierarchy(self, *, workers=1, use_numba=False):
         """
         Create the hierarchical structure from the source data.
+
+        :param workers: The number of threads traversing independent subtrees. Only the Numba compiled traversal runs in parallel.
+        :param use_numba: If True and Numba is installed, large hierarchies are built with the compiled traversal.
+            It is not faster than the memoized Python traversal end to end: the compiled kernels, the only part run by
+            the workers, take a small fraction of the build, which is dominated by turning their output into labeled tuples.
+        :raises ValueError: If `workers` is not a positive integer or the source data contains a cycle.
         """
-        self.hierarchy = set()
+        if not isinstance(workers, int) or workers < 1:
+            logger.error(f"Failed to create the hierarchy: `workers` must be a positive integer, got {workers!r}")
+            raise ValueError("`workers` must be a positive integer")
+
+        self.hierarchy = []
+        self._max_depth = 0
 
         if self.source is not None:
-            self._create_mapping()
-            roots = {self._find_root(parent) for parent in self.parent_map.keys()}
-            for root in roots:
-                self._build_path(root, [])
+            edges = self._create_mapping()
+            roots = self.parent_map.keys() - self.child_map.keys()  # nodes without a parent
+            n_nodes = len(roots) + len(self.child_map)
+            try:
+                if use_numba and hierarchyjit.NUMBA_AVAILABLE and n_nodes >= hierarchyjit.JIT_MIN_NODES:
+                    self._check_cycles()
+                    self._build_paths_jit(edges, workers)
+                else:
+                    if workers > 1:
+                        logger.warning(f"`workers={workers}` is ignored, as the hierarchy is built with the Python traversal.")
+                    subpaths_cache = {}  # dropped once the build is done, as nothing reads it afterwards
+                    n_entered = sum(self._build_path(root, subpaths_cache) for root in roots)
+                    if n_entered < n_nodes:  # the nodes not reached from any root are on or below a cycle without a root
+                        self._check_cycles()
+            except ValueError as e:
+                self.hierarchy = None
+                logger.error(f"Failed to create the hierarchy: {e}")
+                raise
             logger.info("Successfully created hierarchy.")
         else:
             logger.warning("Failed to create the hierarchy. The source attribute is None.")
@@ -143,33 +356,39 @@ class Hierarchy:
         This method resets the hierarchy attribute to None, effectively deleting the current hierarchical structure.
         """
         self.hierarchy = None
+        self._max_depth = 0
 
-    def _flatten_hierarchy(self, *args):
+    def _iter_flattened(self, empty_value, has_primkey):
         """
-        Flatten the hierarchical structure into a list of tuples.
+        Lazily flatten the hierarchical structure into tuples of the same length.
 
-        :param args: 
-            The first argument is the value to be used for filling missing elements.
-            The second argument is a boolean flag. If True, the last element of each tuple is appended to the end. If False, the last element is not appended.
-        :return: A list of flattened tuples, each of the same length.
+        :param empty_value: The value to be used for filling missing elements.
+        :param has_primkey: If True, the last element of each path is appended to the end.
+        :return: A generator of flattened tuples.
         """
-        max_length = max(len(lst) for lst in self.hierarchy)
-        flattened_data = []
-        for lst in self.hierarchy:
-            flattened_data.append(lst + tuple([args[0]] * (max_length - len(lst))) + lst[-1:None if args[1] else 0])
-        return flattened_data
+        padding = (empty_value,) * self._max_depth
+        if has_primkey:
+            for lst in self.hierarchy:
+                yield lst + padding[len(lst):] + lst[-1:]
+        else:
+            for lst in self.hierarchy:
+                yield lst + padding[len(lst):]
 
     def to_tuples(self, *, flattened=True, empty_value=None, has_primkey=True) -> set[tuple] | None:
         """
         Get the hierarchical structure as a set of tuples.
+        The flattened tuples are streamed into the set, without an intermediate list.
 
         :return: The hierarchical paths.
+        :raises ValueError: If the hierarchy is created by this call and the source data contains a cycle.
         """
         if self.hierarchy is None:
             self.create_hierarchy()
 
         try:
-            return set(self._flatten_hierarchy(empty_value, has_primkey)) if flattened else self.hierarchy
+            if not flattened:
+                return set(self.hierarchy)
+            return set(self._iter_flattened(empty_value, has_primkey))
         except Exception as e:
             logger.error(f"Failed to get the hierarchy as a set of tuples: {e}")
             return None
@@ -179,12 +398,19 @@ class Hierarchy:
         Get the hierarchical structure as a list of lists.
 
         :return: The hierarchical paths.
+        :raises ValueError: If the hierarchy is created by this call and the source data contains a cycle.
         """
         if self.hierarchy is None:
             self.create_hierarchy()
 
         try:
-            return [list(path) for path in (self._flatten_hierarchy(empty_value, has_primkey) if flattened else self.hierarchy)]
+            if not flattened:
+                return [list(path) for path in self.hierarchy]
+            # The padded lists are unpacked from the paths directly, without an intermediate object array
+            padding = (empty_value,) * self._max_depth
+            if has_primkey:
+                return [[*path, *padding[len(path):], path[-1]] for path in self.hierarchy]
+            return [[*path, *padding[len(path):]] for path in self.hierarchy]
         except Exception as e:
             logger.error(f"Failed to get the hierarchy as a list of lists: {e}")
             return None
@@ -198,14 +424,22 @@ class Hierarchy:
         :param has_primkey: A boolean indicating whether the DataFrame should include a primary key column.
         :param primkey_label: The label to use for the primary key column. If not provided, the default primary key label is used.
         :return: A DataFrame containing the flattened hierarchy. Returns None if an error occurs.
+        :raises ValueError: If the hierarchy is created by this call and the source data contains a cycle.
         """
         if self.hierarchy is None:
             self.create_hierarchy()
 
         try:
-            max_length = max(len(lst) for lst in self.hierarchy)
-            return pd.DataFrame(self._flatten_hierarchy(empty_value, has_primkey),
-                                columns=[f"{level_label or self.level}{i + 1:02d}" for i in range(max_length)] + [primkey_label or self.primkey])
+            # The column types are inferred from the values, padding included, so the levels and the primary key get the
+            # same types as the labels (e.g. int64, or float64 with NaN padding for integer labels)
+            if empty_value is None:
+                df = pd.DataFrame(self.hierarchy, columns=range(self._max_depth))  # pandas pads the shorter paths with None
+                if has_primkey:
+                    df[self._max_depth] = [path[-1] for path in self.hierarchy]
+            else:
+                df = pd.DataFrame(list(self._iter_flattened(empty_value, has_primkey)), columns=range(self._max_depth + (1 if has_primkey else 0)))
+            df.columns = [f"{level_label or self.level}{i + 1:02d}" for i in range(self._max_depth)] + ([primkey_label or self.primkey] if has_primkey else [])
+            return df
         except Exception as e:
             logger.error(f"Failed to get the hierarchy as a pandas DataFrame: {e}")
             return None
@@ -218,33 +452,63 @@ class Hierarchy:
         """
         if self.hierarchydb is not None:
             data = self.hierarchydb.read_data(**self.metadata.to_dict('source'))
+            if data is not None and not isinstance(data, pd.DataFrame):
+                data = self._collect_chunks(data)
             if data is not None:
                 self.source = data
                 logger.info("Data retrieval successful. The source attribute has been updated.")
             else:
                 logger.warning("Data retrieval failed. The source attribute remains unchanged.")
 
+    @staticmethod
+    def _collect_chunks(chunks):
+        """
+        Collect the source data read from the database in chunks into a single DataFrame.
+        The chunks are only concatenated: the source query already selects distinct rows by default, and `_create_mapping` drops duplicate edges anyway.
+
+        :param chunks: An iterable of DataFrames.
+        :return: The DataFrame of the rows or None if an error occurs.
+        """
+        try:
+            return pd.concat(chunks, ignore_index=True)
+        except Exception as e:
+            logger.error(f"Failed to read data in chunks: {e}")
+            return None
+
+    def _destination_config(self):
+        """
+        Get the destination settings of the configuration file.
+        The section is read on the first call and cached, so repeated writes do not parse the configuration again.
+
+        :return: A dictionary of the destination settings.
+        """
+        if self._destination is None:
+            self._destination = self.metadata.to_dict('destination')
+        return self._destination
+
     def to_database(self, *, empty_value: int | str = None, level_label=None, has_primkey=True, primkey_label=None, **kwargs):
         """
         Write the hierarchy data to the database.
 
         :raises Exception: If there is an issue writing the hierarchy to the database.
+        :raises ValueError: If the hierarchy is created by this call and the source data contains a cycle.
         """
         if self.hierarchy is None:
             self.create_hierarchy()
 
         try:
+            destination = self._destination_config()
             self.hierarchydb.write_data(
                 self.to_dataframe(
                     empty_value=empty_value,
-                    level_label=level_label or self.metadata.get('destination', 'level'),
+                    level_label=level_label or destination.get('level'),
                     has_primkey=has_primkey,
-                    primkey_label=primkey_label or self.metadata.get('destination', 'primkey')),
-                **self.metadata.to_dict('destination'),
+                    primkey_label=primkey_label or destination.get('primkey')),
+                **destination,
                 **kwargs)
 
-            table = self.metadata.get('destination', 'table')
-            schema = self.metadata.get('destination', 'schema')
+            table = destination.get('table')
+            schema = destination.get('schema')
             logger.info(f"Successfully wrote hierarchy to database table '{table}' in schema '{schema}'.")
         except Exception as e:
             logger.error(f"Failed to write hierarchy to database: {e}")
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import functools
 import oracledb
 from sqlalchemy import create_engine
 import pandas as pd
@@ -58,7 +59,39 @@ class HierarchyDBOracle(HierarchyDB):
 
         return create_engine(f'oracle+oracledb://{self.user}:{self.password}@{cp.host}:{cp.port}/?service_name={cp.service_name}', thick_mode=thick_mode)
 
-    def read_data(self, *, schema=None, table=None, parent=None, child=None, where='', **kwargs):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _source_query(schema, table, parent, child, where, distinct, filter_self_loops):
+        """
+        Builds the query reading the parent-child pairs, memoized by its parameters.
+
+        :param schema: The database schema.
+        :param table: The database table name.
+        :param parent: The parent column name.
+        :param child: The child column name.
+        :param where: Where clause optionally.
+        :param distinct: If True, duplicate pairs are removed by the database.
+        :param filter_self_loops: If True, the pairs whose parent equals the child are left out.
+        :return: The SELECT statement.
+        """
+        conditions = [f"({where})"] if where != '' else []
+        if filter_self_loops:
+            conditions.append(f"({parent} <> {child} OR {parent} IS NULL OR {child} IS NULL)")
+        return f"SELECT {'DISTINCT ' if distinct else ''}{parent}, {child} FROM {schema}.{table} {('WHERE ' + ' AND '.join(conditions)) if conditions else ''}"
+
+    @staticmethod
+    def _as_bool(value):
+        """
+        Interprets a flag that may come from the configuration file as a string.
+
+        :param value: A boolean or a string such as 'true', 'yes', 'on' or '1'.
+        :return: The boolean value of the flag.
+        """
+        if isinstance(value, str):
+            return value.strip().lower() in ('1', 'true', 'yes', 'on')
+        return bool(value)
+
+    def read_data(self, *, schema=None, table=None, parent=None, child=None, where='', chunksize=None, distinct=True, filter_self_loops=False, **kwargs):
         """
         Reads hierarchy data from the specified database table.
 
@@ -68,27 +101,47 @@ class HierarchyDBOracle(HierarchyDB):
         :param parent: The parent column name.
         :param child: The child column name.
         :param where: Where clause optionally.
-        :return: DataFrame containing the hierarchy data or None if an error occurs.
+        :param chunksize: If given, the number of rows per chunk. The rows are then streamed with a server-side cursor.
+        :param distinct: If True (default), duplicate rows are removed by the database with SELECT DISTINCT.
+        :param filter_self_loops: If True, the rows whose parent equals the child are left out by the database.
+            Nodes defined only by such a row are then missing from the hierarchy.
+        :return: DataFrame containing the hierarchy data, a generator of DataFrames of at most `chunksize` rows if `chunksize` is given, or None if an error occurs.
         :raises ValueError: If any of the required parameters ('schema', 'table', 'parent', 'child') are not provided.
         :raises Exception: If there is an issue reading from the database.
         """
         if not all((schema, table, parent, child)):
             raise ValueError("All parameters 'schema', 'table', 'parent', and 'child' must be provided.")
 
-        source_query = f"SELECT {parent}, {child} FROM {schema}.{table} {('WHERE ' + where) if where != '' else ''}"
+        source_query = self._source_query(schema, table, parent, child, where, self._as_bool(distinct), self._as_bool(filter_self_loops))
 
         if self.engine is None:
             self._create_engine()
 
+        if chunksize:
+            return self._read_chunks(source_query, int(chunksize))
+
         try:
             return pd.read_sql(source_query, con=self.engine)
         except Exception as e:
             logger.error(f"Failed to read data: {e}")
             return None
 
+    def _read_chunks(self, source_query, chunksize):
+        """
+        Reads the result of the query in chunks through a server-side cursor.
+        The connection stays open until the generator is exhausted or closed.
+
+        :param source_query: The query to execute.
+        :param chunksize: The number of rows per chunk.
+        :return: A generator of DataFrames of at most `chunksize` rows.
+        """
+        with self.engine.connect().execution_options(stream_results=True) as connection:
+            yield from pd.read_sql(source_query, con=connection, chunksize=chunksize)
+
     def write_data(self, df: pd.DataFrame, *, schema=None, table=None, **kwargs):
         """
         Writes hierarchy data to the specified database table.
+        The rows are inserted in batches of `chunksize` rows (10,000 by default); SQLAlchemy sends each batch with a single executemany call.
 
         :param df: DataFrame containing the hierarchy data to write.
         :param schema: The database schema.
@@ -100,7 +153,8 @@ class HierarchyDBOracle(HierarchyDB):
             raise ValueError("All parameters 'schema' and 'table' must be provided.")
 
         try:
-            df.to_sql(table, self.engine, schema=schema, if_exists=typing.cast(typing.Literal["append", "fail", "replace"], kwargs.get("if_exists", "fail")), index=False)
+            df.to_sql(table, self.engine, schema=schema, if_exists=typing.cast(typing.Literal["append", "fail", "replace"], kwargs.get("if_exists", "fail")), index=False,
+                      chunksize=int(kwargs.get("chunksize") or 10_000))
         except Exception as e:
             logger.error(f"Failed to write data to database: {e}")
             raise
@@ -0,0 +1,89 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+NUMBA_AVAILABLE = njit is not None
+
+# Below this number of nodes the pure Python traversal is used, as it is not worth the JIT compilation.
+JIT_MIN_NODES = 10_000
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True, nogil=True)
+    def count_paths(indptr, indices, roots):
+        """
+        Count the paths reachable from the given roots of a graph in CSR form.
+
+        :param indptr: The offsets of the children of each node in `indices`.
+        :param indices: The children of the nodes, concatenated.
+        :param roots: The ids of the root nodes.
+        :return: The number of paths and the length of the longest path.
+        """
+        n = indptr.shape[0] - 1
+        nodes = np.empty(n, np.int32)
+        pos = np.empty(n, np.int64)
+        n_paths = 0
+        max_depth = 0
+        for root in roots:
+            nodes[0] = root
+            pos[0] = indptr[root]
+            depth = 1
+            n_paths += 1
+            max_depth = max(max_depth, 1)
+            while depth > 0:
+                top = depth - 1
+                if pos[top] < indptr[nodes[top] + 1]:
+                    child = indices[pos[top]]
+                    pos[top] += 1
+                    nodes[depth] = child
+                    pos[depth] = indptr[child]
+                    depth += 1
+                    n_paths += 1
+                    max_depth = max(max_depth, depth)
+                else:
+                    depth -= 1
+        return n_paths, max_depth
+
+    @njit(cache=True, nogil=True)
+    def dfs_paths(indptr, indices, roots, out_nodes, out_parents, max_depth):
+        """
+        Write the paths reachable from the given roots of a graph in CSR form into preallocated buffers.
+
+        Each path is stored as its last node and the index of the path it extends (-1 for a root), in depth-first order,
+        so every path is written after the path it extends.
+
+        :param indptr: The offsets of the children of each node in `indices`.
+        :param indices: The children of the nodes, concatenated.
+        :param roots: The ids of the root nodes.
+        :param out_nodes: The buffer receiving the last node of each path.
+        :param out_parents: The buffer receiving the index of the path each path extends.
+        :param max_depth: The length of the longest path, as returned by `count_paths`.
+        """
+        nodes = np.empty(max_depth, np.int32)
+        pos = np.empty(max_depth, np.int64)
+        paths = np.empty(max_depth, np.int64)
+        n_paths = 0
+        for root in roots:
+            nodes[0] = root
+            pos[0] = indptr[root]
+            paths[0] = n_paths
+            out_nodes[n_paths] = root
+            out_parents[n_paths] = -1
+            n_paths += 1
+            depth = 1
+            while depth > 0:
+                top = depth - 1
+                if pos[top] < indptr[nodes[top] + 1]:
+                    child = indices[pos[top]]
+                    pos[top] += 1
+                    nodes[depth] = child
+                    pos[depth] = indptr[child]
+                    paths[depth] = n_paths
+                    out_nodes[n_paths] = child
+                    out_parents[n_paths] = paths[top]
+                    n_paths += 1
+                    depth += 1
+                else:
+                    depth -= 1
@@ -20,8 +20,12 @@ setup(
     install_requires=[
         'bennet-observer @ git+https://github.com/zbenke71/observer.git@0.1',
         'bennet-config @ git+https://github.com/zbenke71/config.git@0.1',
+        'numpy>=1.23.2',
         'oracledb>=3.4.1',
         'pandas>=2.3.3',
         'sqlalchemy>=2.0.44',
     ],
+    extras_require={
+        'numba': ['numba>=0.59'],
+    },
 )